@@ -0,0 +1,45 @@
+import numpy as np
+
+# The header is always this long, so it can be rewritten in place with the
+# final number of frames once done
+HEADER_SIZE = 256
+MAGIC = b'\x93NUMPY\x01\x00'
+
+
+class RawFrameWriter:
+    """
+    Appends equally shaped frames to a .npy file one at a time, so memory
+    stays constant no matter how many frames are written. The result is a
+    regular (frames, ...) array, e.g. for 'np.load(path, mmap_mode='r')'.
+    """
+
+    def __init__(self, path, frame_shape, dtype=np.int64):
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.num_frames = 0
+        self.file = open(path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        header = repr({
+            'descr': np.lib.format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': (self.num_frames,) + self.frame_shape,
+        })
+        header_len = HEADER_SIZE - len(MAGIC) - 2
+        header = header.ljust(header_len - 1) + '\n'
+        assert len(header) == header_len
+        self.file.seek(0)
+        self.file.write(MAGIC)
+        self.file.write(np.uint16(header_len).tobytes())
+        self.file.write(header.encode('latin1'))
+
+    def append(self, frame):
+        assert frame.shape == self.frame_shape
+        self.file.seek(0, 2)
+        self.file.write(np.ascontiguousarray(frame, self.dtype).tobytes())
+        self.num_frames += 1
+
+    def close(self):
+        self._write_header()
+        self.file.close()
@@ -0,0 +1,108 @@
+""" Softened gravity kernels for the N-body solvers.
+
+The kernel is a compile time choice ('ti.template()'), so the solvers only
+contain the code of the selected one, while the softening length 'h' and the
+kernel 'scale' (cutoff radius or screening length) are ordinary run time
+values. 'distance' is always 'other position - position', so the
+accelerations point towards the other body (per unit mass of it).
+
+    PLUMMER: 1 / sqrt(r^2 + h^2) potential
+    SPLINE:  Monaghan cubic spline softening (as in GADGET), exactly
+             Newtonian beyond r = h
+    CUTOFF:  Newtonian, shifted to vanish at r = scale, no force beyond it.
+             Inside r = h the force falls linearly to 0 (uniform sphere)
+    YUKAWA:  screened exp(-s / scale) / s potential, s = sqrt(r^2 + h^2)
+"""
+import taichi as ti
+
+PLUMMER = 0
+SPLINE = 1
+CUTOFF = 2
+YUKAWA = 3
+
+
+@ti.func
+def spline_force(r, h):
+    """
+    :return: the factor 'f' of the spline softened acceleration 'f * d'
+    """
+    ret = 0.0
+    if r >= h:
+        ret = 1 / (r * r * r)
+    else:
+        u = r / h
+        h_inv3 = 1 / (h * h * h)
+        if u < 0.5:
+            ret = h_inv3 * (10.666666667 + u * u * (32.0 * u - 38.4))
+        else:
+            ret = h_inv3 * (21.333333333 - 48.0 * u + 38.4 * u * u -
+                            10.666666667 * u * u * u -
+                            0.066666667 / (u * u * u))
+    return ret
+
+
+@ti.func
+def spline_potential(r, h):
+    ret = 0.0
+    if r >= h:
+        ret = -1 / r
+    else:
+        u = r / h
+        u2 = u * u
+        if u < 0.5:
+            ret = (-2.8 + u2 * (5.333333333 + u2 * (6.4 * u - 9.6))) / h
+        else:
+            ret = (-3.2 + 0.066666667 / u + u2 *
+                   (10.666666667 + u * (-16.0 + u * (9.6 - 2.133333333 * u)))
+                   ) / h
+    return ret
+
+
+@ti.func
+def gravity(kernel: ti.template(), distance, h, scale):
+    """
+    :return: the acceleration towards a unit mass at 'distance'
+    """
+    r2 = distance.norm_sqr()
+    ret = distance * 0
+    if ti.static(kernel == PLUMMER):
+        inv = ti.rsqrt(r2 + h * h)
+        ret = distance * (inv * inv * inv)
+    elif ti.static(kernel == SPLINE):
+        ret = distance * spline_force(ti.sqrt(r2), h)
+    elif ti.static(kernel == CUTOFF):
+        if r2 < scale * scale:
+            inv = ti.rsqrt(max(r2, h * h))
+            ret = distance * (inv * inv * inv)
+    else:  # YUKAWA
+        s2 = r2 + h * h
+        inv = ti.rsqrt(s2)
+        s = s2 * inv
+        ret = distance * (ti.exp(-s / scale) * (1 + s / scale) *
+                          (inv * inv * inv))
+    return ret
+
+
+@ti.func
+def potential(kernel: ti.template(), distance, h, scale):
+    """
+    :return: the potential of a unit mass at 'distance', its negative
+    gradient is 'gravity'
+    """
+    r2 = distance.norm_sqr()
+    ret = 0.0
+    if ti.static(kernel == PLUMMER):
+        ret = -ti.rsqrt(r2 + h * h)
+    elif ti.static(kernel == SPLINE):
+        ret = spline_potential(ti.sqrt(r2), h)
+    elif ti.static(kernel == CUTOFF):
+        if r2 < scale * scale:
+            if r2 < h * h:
+                ret = -(3 * h * h - r2) / (2 * h * h * h) + 1 / scale
+            else:
+                ret = -ti.rsqrt(r2) + 1 / scale
+    else:  # YUKAWA
+        s2 = r2 + h * h
+        inv = ti.rsqrt(s2)
+        ret = -ti.exp(-s2 * inv / scale) * inv
+    return ret
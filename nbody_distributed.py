@@ -0,0 +1,327 @@
+""" Domain decomposed N-body over several processes.
+
+Every worker owns the particles in one range of Morton keys (so one compact
+region of space) and runs the 'nbody_quad' solver on them. Each step:
+
+1. Decompose: split the Morton curve in ranges holding the same number of
+   particles, and send every particle to the owner of its range.
+2. Exchange the 'locally essential trees': every worker walks its own tree
+   for every other worker's domain and sends the parts that domain needs,
+   i.e. the particles close to it and (centroid, mass) pseudo-particles for
+   the nodes far enough away, with the same opening criterion as
+   'get_tree_gravity_at'.
+3. Step the owned particles with the imported ones added to the local tree.
+
+The workers talk through a 'Transport' (point to point messages of any
+picklable object). 'MultiprocessingTransport' runs them as processes on one
+machine, for testing; another backend (e.g. MPI) only needs 'send' and
+'recv'.
+"""
+import itertools
+import math
+import multiprocessing as mp
+from collections import defaultdict, deque
+
+import numpy as np
+
+import nbody_quad as nb
+
+MORTON_BITS = 16  # per dimension
+# Number of keys each worker contributes to choose the domain boundaries
+SPLITTER_SAMPLES = 64
+
+
+# -------------------------------- Transport ---------------------------------
+
+class Transport:
+    """
+    Messages between 'size' workers, this one being 'rank'. Subclasses
+    implement 'send' (must not block) and 'recv', the collectives are built
+    on top of them.
+    """
+
+    def __init__(self, rank, size):
+        self.rank = rank
+        self.size = size
+
+    def send(self, dest, obj):
+        raise NotImplementedError
+
+    def recv(self, source):
+        raise NotImplementedError
+
+    def alltoall(self, objs):
+        """
+        :param objs: one object for every worker
+        :return: the objects every worker sent to this one
+        """
+        for dest in range(self.size):
+            if dest != self.rank:
+                self.send(dest, objs[dest])
+        return [objs[source] if source == self.rank else self.recv(source)
+                for source in range(self.size)]
+
+    def allgather(self, obj):
+        return self.alltoall([obj] * self.size)
+
+    def gather(self, obj, root=0):
+        """
+        :return: the objects of all the workers on 'root', None elsewhere
+        """
+        if self.rank != root:
+            self.send(root, obj)
+            return None
+        return [obj if source == root else self.recv(source)
+                for source in range(self.size)]
+
+
+class MultiprocessingTransport(Transport):
+    """
+    One 'multiprocessing' queue per worker as its inbox.
+    """
+
+    def __init__(self, rank, inboxes):
+        super().__init__(rank, len(inboxes))
+        self.inboxes = inboxes
+        # Messages received while waiting for another source
+        self.pending = defaultdict(deque)
+
+    def send(self, dest, obj):
+        self.inboxes[dest].put((self.rank, obj))
+
+    def recv(self, source):
+        while not self.pending[source]:
+            sender, obj = self.inboxes[self.rank].get()
+            self.pending[sender].append(obj)
+        return self.pending[source].popleft()
+
+
+def _worker_main(transport, target, args, results):
+    try:
+        results.put((transport.rank, target(transport, *args), None))
+    except Exception as e:
+        # The others are likely stuck waiting for this one, but the caller
+        # is not
+        results.put((transport.rank, None, e))
+        raise
+
+
+def run_local(num_workers, target, *args):
+    """
+    Run 'target(transport, *args)' in 'num_workers' processes.
+
+    :return: the return values of all the workers, by rank. If one raises,
+    the others are stopped and its exception is raised here
+    """
+    # Taichi does not survive a fork, so start fresh interpreters
+    ctx = mp.get_context('spawn')
+    inboxes = [ctx.Queue() for _ in range(num_workers)]
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_worker_main,
+                           args=(MultiprocessingTransport(rank, inboxes),
+                                 target, args, results))
+               for rank in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    ret = {}
+    for _ in workers:
+        rank, value, error = results.get()
+        if error is not None:
+            for worker in workers:
+                worker.terminate()
+            raise RuntimeError('worker {} failed'.format(rank)) from error
+        ret[rank] = value
+    for worker in workers:
+        worker.join()
+    return [ret[rank] for rank in range(num_workers)]
+
+
+# ----------------------------- Decomposition --------------------------------
+
+def morton_keys(pos):
+    """
+    :param pos: (n, DIM) positions in [0, 1]
+    :return: their Morton (Z-order) keys
+    """
+    q = np.clip(pos * (1 << MORTON_BITS), 0,
+                (1 << MORTON_BITS) - 1).astype(np.uint64)
+    keys = np.zeros(len(pos), dtype=np.uint64)
+    for bit in range(MORTON_BITS):
+        for d in range(pos.shape[1]):
+            keys |= ((q[:, d] >> np.uint64(bit)) & np.uint64(1)) << \
+                np.uint64(bit * pos.shape[1] + d)
+    return keys
+
+
+def decompose(transport, particles):
+    """
+    Send every particle to the worker owning its Morton key range, the ranges
+    being chosen so each worker gets about as many particles.
+
+    :param particles: dict of 'pos', 'vel' and 'mass' arrays
+    :return: the particles this worker owns now
+    """
+    keys = morton_keys(particles['pos'])
+    samples = np.sort(keys)[np.linspace(0, len(keys) - 1, SPLITTER_SAMPLES)
+                            .astype(int)] if len(keys) else keys
+    samples = np.sort(np.concatenate(transport.allgather(samples)))
+    splitters = samples[(np.arange(1, transport.size) * len(samples)) //
+                        transport.size]
+    owner = np.searchsorted(splitters, keys, side='right')
+    outgoing = [{k: v[owner == rank] for k, v in particles.items()}
+                for rank in range(transport.size)]
+    incoming = transport.alltoall(outgoing)
+    return {k: np.concatenate([part[k] for part in incoming])
+            for k in particles}
+
+
+def _box_distance(point, lower, upper):
+    return np.linalg.norm(np.maximum(0, np.maximum(lower - point,
+                                                   point - upper)))
+
+
+def essential_particles(tree, lower, upper):
+    """
+    Walk the tree like 'get_tree_gravity_at' does, but for any point in the
+    box [lower, upper] at once: nodes far enough from the whole box become
+    pseudo-particles, the others are opened.
+
+    :param tree: the node and particle tables of 'nbody_quad', as arrays
+    :return: positions and masses of what the box needs from this tree,
+    together as heavy as all the particles of the tree
+    """
+    children, node_mass, node_centroid_pos, node_particle_id, pos, mass = \
+        tree
+    out_pos, out_mass = [], []
+    stack = [(0, 1.0)]
+    while stack:
+        parent, parent_geo_size = stack.pop()
+        particle_id = node_particle_id[parent]
+        if particle_id >= 0:
+            out_pos.append(pos[particle_id])
+            out_mass.append(mass[particle_id])
+            continue
+        for which in itertools.product(range(2), repeat=nb.DIM):
+            child = children[(parent,) + which]
+            if child == nb.LEAF:
+                continue
+            node_center = node_centroid_pos[child] / node_mass[child]
+            if _box_distance(node_center, lower, upper) > \
+                    nb.SHAPE_FACTOR * parent_geo_size:
+                out_pos.append(node_center)
+                out_mass.append(node_mass[child])
+            else:
+                stack.append((child, parent_geo_size * 0.5))
+    out_mass = np.array(out_mass, dtype=np.float32)
+    # Whatever the walk misses is missing from the tree, and would silently
+    # be lost for the other domain
+    if not np.isclose(out_mass.sum(dtype=np.float64),
+                      mass.sum(dtype=np.float64), rtol=1e-4):
+        raise RuntimeError('exported mass {} != domain mass {}'.format(
+            out_mass.sum(dtype=np.float64), mass.sum(dtype=np.float64)))
+    return np.array(out_pos, dtype=np.float32).reshape(-1, nb.DIM), out_mass
+
+
+# --------------------------------- Solver -----------------------------------
+
+def load_particles(pos, vel, mass):
+    n = len(mass)
+    if n > nb.NUM_MAX_PARTICLE:
+        raise ValueError('{} particles (owned and imported) do not fit in '
+                         'NUM_MAX_PARTICLE = {}'.format(n,
+                                                        nb.NUM_MAX_PARTICLE))
+    padded_pos = np.zeros((nb.NUM_MAX_PARTICLE, nb.DIM), dtype=np.float32)
+    padded_vel = np.zeros((nb.NUM_MAX_PARTICLE, nb.DIM), dtype=np.float32)
+    padded_mass = np.zeros(nb.NUM_MAX_PARTICLE, dtype=np.float32)
+    padded_pos[:n], padded_vel[:n], padded_mass[:n] = pos, vel, mass
+    nb.particle_pos.from_numpy(padded_pos)
+    nb.particle_vel.from_numpy(padded_vel)
+    nb.particle_mass.from_numpy(padded_mass)
+    nb.num_particles[None] = n
+
+
+def local_tree(particles):
+    load_particles(particles['pos'], particles['vel'], particles['mass'])
+    nb.build_tree()
+    return (nb.node_children.to_numpy(), nb.node_mass.to_numpy(),
+            nb.node_centroid_pos.to_numpy(), nb.node_particle_id.to_numpy(),
+            particles['pos'], particles['mass'])
+
+
+def step(transport, particles):
+    """
+    One 'substep_tree' of the whole simulation.
+
+    :return: the particles this worker owns after the step
+    """
+    particles = decompose(transport, particles)
+    own = len(particles['mass'])
+    box = None
+    if own:
+        box = particles['pos'].min(axis=0), particles['pos'].max(axis=0)
+    boxes = transport.allgather(box)
+
+    exports = [None] * transport.size
+    if own:
+        tree = local_tree(particles)
+        for rank, other in enumerate(boxes):
+            if rank != transport.rank and other is not None:
+                exports[rank] = essential_particles(tree, *other)
+    imports = [part for part in transport.alltoall(exports)
+               if part is not None]
+
+    # The imported particles only pull on the owned ones, whatever happens
+    # to them in the step is dropped
+    pos = np.concatenate([particles['pos']] + [p for p, _ in imports])
+    mass = np.concatenate([particles['mass']] + [m for _, m in imports])
+    vel = np.zeros_like(pos)
+    vel[:own] = particles['vel']
+    load_particles(pos, vel, mass)
+    nb.build_tree()
+    nb.substep_tree()
+    return {'pos': nb.particle_pos.to_numpy()[:own],
+            'vel': nb.particle_vel.to_numpy()[:own],
+            'mass': particles['mass']}
+
+
+def initial_particles(num_particles, rng):
+    """
+    Same distribution as 'nbody_quad.initialize'.
+    """
+    mass = rng.random(num_particles) * 1.4 + 0.1
+    a = rng.random(num_particles) * math.tau
+    r = np.sqrt(rng.random(num_particles)) * 0.3
+    pos = 0.5 + np.stack([np.cos(a), np.sin(a)], axis=1) * r[:, None]
+    return {'pos': pos.astype(np.float32),
+            'vel': np.zeros_like(pos, dtype=np.float32),
+            'mass': mass.astype(np.float32)}
+
+
+def simulate(transport, num_particles, steps, seed=0):
+    """
+    Worker entry point: every worker starts with its share of the particles,
+    they end up on their owners after the first decomposition.
+
+    :return: all the particles (gathered on rank 0), None on other ranks
+    """
+    nb.init()
+    share = num_particles // transport.size
+    if transport.rank < num_particles % transport.size:
+        share += 1
+    particles = initial_particles(
+        share, np.random.default_rng([seed, transport.rank]))
+    for _ in range(steps):
+        particles = step(transport, particles)
+    parts = transport.gather(particles)
+    if parts is None:
+        return None
+    return {k: np.concatenate([part[k] for part in parts])
+            for k in particles}
+
+
+if __name__ == '__main__':
+    result = run_local(4, simulate, 8192, 10)[0]
+    print('{} particles, center of mass {}'.format(
+        len(result['mass']),
+        (result['pos'] * result['mass'][:, None]).sum(axis=0) /
+        result['mass'].sum()))
@@ -0,0 +1,372 @@
+""" Many small, independent N-body systems stepped together.
+
+Same quadtree solver as 'nbody_quad', but every table has an extra leading
+'system' dimension, so 'NUM_SYSTEMS' systems of up to 'NUM_MAX_PARTICLE'
+particles each are built and stepped by one kernel launch. Each system is
+still processed serially (the tree build and traversal are), but the
+systems run in parallel, which keeps all cores busy even when a single
+system is too small to be worth parallelizing.
+
+Meant for parameter sweeps: every system has its own initial radius, mass
+scale, time step and gravity kernel parameters, see 'set_parameters'.
+"""
+import math
+
+import numpy as np
+import taichi as ti
+
+import gravity_kernels
+import taichi_setup
+from nbody_quad import DIM, DT, LEAF, TREE, SHAPE_FACTOR, SOFTENING_LENGTH, \
+    KERNEL_SCALE, boundReflect
+
+NUM_SYSTEMS = 256
+NUM_MAX_PARTICLE = 512
+GRAVITY_KERNEL = gravity_kernels.PLUMMER
+
+# Per system tree tables, same sizes as in 'nbody_quad'
+T_MAX_DEPTH = 1 * NUM_MAX_PARTICLE
+T_MAX_NODES = 4 * T_MAX_DEPTH
+
+
+def init(arch=ti.cpu, offline_cache=False, cache_path=None):
+    """
+    Initialize Taichi and allocate all the fields, see 'nbody_quad.init'.
+    """
+    global particle_pos, particle_vel, particle_mass, num_particles, \
+        node_mass, node_centroid_pos, node_particle_id, node_children, \
+        node_table_len, trash_particle_id, trash_base_parent, \
+        trash_base_geo_center, trash_base_geo_size, trash_table_len, \
+        system_radius, system_mass_scale, system_dt, system_softening, \
+        system_kernel_scale, diag_kinetic, diag_potential, diag_momentum, \
+        diag_angular_momentum
+    taichi_setup.init_taichi(arch, offline_cache, cache_path, timer=False)
+
+    # The particles of a system are contiguous
+    particle_pos = ti.Vector.field(n=DIM, dtype=ti.f32)
+    particle_vel = ti.Vector.field(n=DIM, dtype=ti.f32)
+    particle_mass = ti.field(dtype=ti.f32)
+    particle_table = ti.root.dense(ti.i, NUM_SYSTEMS).dense(
+        ti.j, NUM_MAX_PARTICLE)
+    particle_table.place(particle_pos).place(particle_vel).place(
+        particle_mass)
+    num_particles = ti.field(dtype=ti.i32, shape=NUM_SYSTEMS)
+
+    node_mass = ti.field(ti.f32)
+    node_centroid_pos = ti.Vector.field(DIM, ti.f32)
+    node_particle_id = ti.field(ti.i32)
+    node_children = ti.field(ti.i32)
+    node_table = ti.root.dense(ti.i, NUM_SYSTEMS).dense(ti.j, T_MAX_NODES)
+    node_table.place(node_particle_id, node_centroid_pos, node_mass)
+    # 'ti.indices' was renamed to 'ti.axes' in newer Taichi versions
+    axes = ti.axes if hasattr(ti, 'axes') else ti.indices
+    node_table.dense(axes(*range(2, 2 + DIM)), 2).place(node_children)
+    node_table_len = ti.field(dtype=ti.i32, shape=NUM_SYSTEMS)
+
+    trash_particle_id = ti.field(ti.i32)
+    trash_base_parent = ti.field(ti.i32)
+    trash_base_geo_center = ti.Vector.field(DIM, ti.f32)
+    trash_base_geo_size = ti.field(ti.f32)
+    trash_table = ti.root.dense(ti.i, NUM_SYSTEMS).dense(ti.j, T_MAX_DEPTH)
+    trash_table.place(trash_particle_id)
+    trash_table.place(trash_base_parent, trash_base_geo_size)
+    trash_table.place(trash_base_geo_center)
+    trash_table_len = ti.field(ti.i32, NUM_SYSTEMS)
+
+    # Parameters of every system
+    system_radius = ti.field(ti.f32, NUM_SYSTEMS)
+    system_mass_scale = ti.field(ti.f32, NUM_SYSTEMS)
+    system_dt = ti.field(ti.f32, NUM_SYSTEMS)
+    system_softening = ti.field(ti.f32, NUM_SYSTEMS)
+    system_kernel_scale = ti.field(ti.f32, NUM_SYSTEMS)
+
+    # f64 like in 'nbody_quad', for the energy drift
+    diag_kinetic = ti.field(ti.f64, NUM_SYSTEMS)
+    diag_potential = ti.field(ti.f64, NUM_SYSTEMS)
+    diag_momentum = ti.Vector.field(DIM, ti.f32, NUM_SYSTEMS)
+    diag_angular_momentum = ti.field(ti.f32, NUM_SYSTEMS)
+
+    set_parameters()
+
+
+def set_parameters(radius=0.3, mass_scale=1.0, dt=DT,
+                   softening=SOFTENING_LENGTH, kernel_scale=KERNEL_SCALE):
+    """
+    Each parameter is either a single value for all the systems or one value
+    per system.
+
+    :param radius: radius of the initial disk of particles
+    :param mass_scale: the masses are drawn in [0.1, 1.5] times this
+    :param dt: time step
+    :param softening: softening length of the gravity kernel
+    :param kernel_scale: cutoff radius or screening length of the kernel
+    """
+    for field, value in ((system_radius, radius),
+                         (system_mass_scale, mass_scale), (system_dt, dt),
+                         (system_softening, softening),
+                         (system_kernel_scale, kernel_scale)):
+        field.from_numpy(np.broadcast_to(
+            np.asarray(value, dtype=np.float32), NUM_SYSTEMS).copy())
+
+
+@ti.func
+def gravity_func(b, distance):
+    return gravity_kernels.gravity(GRAVITY_KERNEL, distance,
+                                   system_softening[b], system_kernel_scale[b])
+
+
+@ti.func
+def potential_func(b, distance):
+    return gravity_kernels.potential(GRAVITY_KERNEL, distance,
+                                     system_softening[b],
+                                     system_kernel_scale[b])
+
+
+@ti.func
+def alloc_node(b):
+    ret = ti.atomic_add(node_table_len[b], 1)
+    assert ret < T_MAX_NODES
+
+    node_mass[b, ret] = 0
+    node_centroid_pos[b, ret] = particle_pos[b, 0] * 0
+    node_particle_id[b, ret] = LEAF
+    for which in ti.grouped(ti.ndrange(*([2] * DIM))):
+        node_children[b, ret, which] = LEAF
+    return ret
+
+
+@ti.func
+def alloc_trash(b):
+    ret = ti.atomic_add(trash_table_len[b], 1)
+    assert ret < T_MAX_DEPTH
+    return ret
+
+
+@ti.func
+def alloc_a_node_for_particle(b, particle_id, parent, parent_geo_center,
+                              parent_geo_size):
+    """
+    'nbody_quad.alloc_a_node_for_particle' within system 'b'.
+    """
+    position = particle_pos[b, particle_id]
+    mass = particle_mass[b, particle_id]
+
+    depth = 0
+    while depth < T_MAX_DEPTH:
+        already_particle_id = node_particle_id[b, parent]
+        if already_particle_id == LEAF:
+            break
+        if already_particle_id != TREE:
+            node_particle_id[b, parent] = TREE
+            trash_id = alloc_trash(b)
+            trash_particle_id[b, trash_id] = already_particle_id
+            trash_base_parent[b, trash_id] = parent
+            trash_base_geo_center[b, trash_id] = parent_geo_center
+            trash_base_geo_size[b, trash_id] = parent_geo_size
+            already_pos = particle_pos[b, already_particle_id]
+            already_mass = particle_mass[b, already_particle_id]
+            node_centroid_pos[b, parent] -= already_pos * already_mass
+            node_mass[b, parent] -= already_mass
+
+        node_centroid_pos[b, parent] += position * mass
+        node_mass[b, parent] += mass
+
+        which = abs(position > parent_geo_center)
+        child = node_children[b, parent, which]
+        if child == LEAF:
+            child = alloc_node(b)
+            node_children[b, parent, which] = child
+
+        child_geo_size = parent_geo_size * 0.5
+        child_geo_center = parent_geo_center + (which - 0.5) * child_geo_size
+
+        parent_geo_center = child_geo_center
+        parent_geo_size = child_geo_size
+        parent = child
+
+        depth = depth + 1
+
+    node_particle_id[b, parent] = particle_id
+    node_centroid_pos[b, parent] = position * mass
+    node_mass[b, parent] = mass
+
+
+@ti.kernel
+def build_tree():
+    """
+    Build the trees of all the systems, one system per thread.
+    """
+    for b in range(NUM_SYSTEMS):
+        node_table_len[b] = 0
+        trash_table_len[b] = 0
+        alloc_node(b)
+
+        particle_id = 0
+        while particle_id < num_particles[b]:
+            alloc_a_node_for_particle(b, particle_id, 0,
+                                      particle_pos[b, 0] * 0 + 0.5, 1.0)
+
+            trash_id = 0
+            # Atomic read of the growing table, see 'nbody_quad.construct_tree'
+            while trash_id < ti.atomic_add(trash_table_len[b], 0):
+                alloc_a_node_for_particle(b, trash_particle_id[b, trash_id],
+                                          trash_base_parent[b, trash_id],
+                                          trash_base_geo_center[b, trash_id],
+                                          trash_base_geo_size[b, trash_id])
+                trash_id = trash_id + 1
+
+            trash_table_len[b] = 0
+            particle_id = particle_id + 1
+
+
+@ti.func
+def get_tree_sum_at(b, position, self_id, func: ti.template(), ret):
+    """
+    Walk the tree of system 'b' (using its trash table as the queue, like
+    'nbody_quad.get_tree_gravity_at') and add up 'mass * func(b, distance)'
+    of the particles and far enough nodes to 'ret', skipping 'self_id'.
+    'func' is 'gravity_func' or 'potential_func'.
+    """
+    trash_table_len[b] = 0
+    trash_id = alloc_trash(b)
+    trash_base_parent[b, trash_id] = 0
+    trash_base_geo_size[b, trash_id] = 1.0
+
+    trash_id = 0
+    while trash_id < trash_table_len[b]:
+        parent = trash_base_parent[b, trash_id]
+        parent_geo_size = trash_base_geo_size[b, trash_id]
+
+        particle_id = node_particle_id[b, parent]
+        if particle_id >= 0:
+            if particle_id != self_id:
+                distance = particle_pos[b, particle_id] - position
+                ret += particle_mass[b, particle_id] * func(b, distance)
+
+        else:  # TREE or LEAF
+            for which in ti.grouped(ti.ndrange(*([2] * DIM))):
+                child = node_children[b, parent, which]
+                if child == LEAF:
+                    continue
+                node_center = node_centroid_pos[b, child] / node_mass[b,
+                                                                      child]
+                distance = node_center - position
+                if distance.norm_sqr() > \
+                        SHAPE_FACTOR ** 2 * parent_geo_size ** 2:
+                    ret += node_mass[b, child] * func(b, distance)
+                else:
+                    new_trash_id = alloc_trash(b)
+                    trash_base_parent[b, new_trash_id] = child
+                    trash_base_geo_size[b, new_trash_id] = \
+                        parent_geo_size * 0.5
+        trash_id = trash_id + 1
+
+    return ret
+
+
+@ti.kernel
+def substep_tree():
+    for b in range(NUM_SYSTEMS):
+        particle_id = 0
+        while particle_id < num_particles[b]:
+            acceleration = get_tree_sum_at(b, particle_pos[b, particle_id],
+                                           particle_id, gravity_func,
+                                           particle_pos[b, 0] * 0)
+            particle_vel[b, particle_id] += acceleration * system_dt[b]
+            particle_vel[b, particle_id] = boundReflect(
+                particle_pos[b, particle_id], particle_vel[b, particle_id],
+                0, 1)
+            particle_id = particle_id + 1
+
+    for b, i in particle_pos:
+        if i < num_particles[b]:
+            particle_pos[b, i] += particle_vel[b, i] * system_dt[b]
+
+
+def initialize(num_p):
+    """
+    Fill every system with 'num_p' particles, each one drawn from its own
+    parameters.
+    """
+    if not 0 <= num_p <= NUM_MAX_PARTICLE:
+        raise ValueError('{} particles do not fit in NUM_MAX_PARTICLE = '
+                         '{}'.format(num_p, NUM_MAX_PARTICLE))
+    fill_systems(num_p)
+
+
+@ti.kernel
+def fill_systems(num_p: ti.i32):
+    for b in range(NUM_SYSTEMS):
+        num_particles[b] = num_p
+    for b, i in ti.ndrange(NUM_SYSTEMS, num_p):
+        particle_mass[b, i] = (ti.random() * 1.4 + 0.1) * system_mass_scale[b]
+
+        a = ti.random() * math.tau
+        r = ti.sqrt(ti.random()) * system_radius[b]
+        particle_pos[b, i] = 0.5 + ti.Vector([ti.cos(a), ti.sin(a)]) * r
+        particle_vel[b, i] = particle_pos[b, i] * 0
+
+
+@ti.kernel
+def compute_moments():
+    for b in range(NUM_SYSTEMS):
+        diag_kinetic[b] = 0
+        diag_momentum[b] = particle_pos[b, 0] * 0
+        diag_angular_momentum[b] = 0
+    for b, i in particle_pos:
+        if i < num_particles[b]:
+            m = particle_mass[b, i]
+            v = particle_vel[b, i]
+            r = particle_pos[b, i] - 0.5
+            diag_kinetic[b] += ti.cast(0.5 * m * v.norm_sqr(), ti.f64)
+            diag_momentum[b] += m * v
+            diag_angular_momentum[b] += m * (r[0] * v[1] - r[1] * v[0])
+
+
+@ti.kernel
+def compute_tree_potential():
+    """
+    Needs up-to-date trees, i.e. call 'build_tree()' first.
+    """
+    for b in range(NUM_SYSTEMS):
+        diag_potential[b] = 0
+        particle_id = 0
+        while particle_id < num_particles[b]:
+            phi = get_tree_sum_at(b, particle_pos[b, particle_id],
+                                  particle_id, potential_func, 0.0)
+            diag_potential[b] += ti.cast(
+                0.5 * particle_mass[b, particle_id] * phi, ti.f64)
+            particle_id = particle_id + 1
+
+
+def get_diagnostics():
+    """
+    :return: dict of kinetic/potential/total energy, momentum and angular
+    momentum, each one an array with one entry per system
+    """
+    compute_moments()
+    compute_tree_potential()
+    kinetic = diag_kinetic.to_numpy()
+    potential = diag_potential.to_numpy()
+    return {
+        'kinetic': kinetic,
+        'potential': potential,
+        'energy': kinetic + potential,
+        'momentum': diag_momentum.to_numpy(),
+        'angular_momentum': diag_angular_momentum.to_numpy(),
+    }
+
+
+if __name__ == '__main__':
+    init()
+    # Sweep the initial radius of the systems
+    set_parameters(radius=np.linspace(0.05, 0.45, NUM_SYSTEMS))
+    initialize(NUM_MAX_PARTICLE)
+
+    for step in range(20):
+        build_tree()
+        if step % 10 == 0:
+            energy = get_diagnostics()['energy']
+            print(f'step {step}: energy {energy.min():.4g} .. '
+                  f'{energy.max():.4g}')
+        substep_tree()
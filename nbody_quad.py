@@ -8,16 +8,25 @@ import taichi as ti
 import math
 import numpy as np
 
+import gravity_kernels
+import taichi_setup
+
 # --------------- Windows timer utils ---------------
 
 import matplotlib.pyplot as plt
 import ctypes
 
-dll = ctypes.WinDLL("C:/Users/xuyan/source/repos/Dll1/x64/Release/Dll1.dll")
+TIMER_DLL = "C:/Users/xuyan/source/repos/Dll1/x64/Release/Dll1.dll"
+# Only loaded by 'timer_init', the timers read 0 without it
+dll = None
+timer_loaded = False
 
 
 def timer_init():
+    global dll, timer_loaded
+    dll = ctypes.WinDLL(TIMER_DLL)
     dll.timer_init()
+    timer_loaded = True
 
 
 def print_results(fname):
@@ -44,70 +53,145 @@ def print_results(fname):
 @ti.func
 def get_time_nanosec():
     nano_sec = ti.cast(0, ti.i64)
-    ti.external_func_call(func=dll.get_time_nanosec,
-                          args=(),
-                          outputs=(nano_sec,))
+    if ti.static(timer_loaded):
+        ti.external_func_call(func=dll.get_time_nanosec,
+                              args=(),
+                              outputs=(nano_sec,))
     return nano_sec
 
 
 # --------------------------------------------------------------------------
 
-ti.init(arch=ti.cpu)
-if not hasattr(ti, 'jkl'):
-    ti.jkl = ti.indices(1, 2, 3)
-
 # Program related
 RES = (640, 480)
 
 # N-body related
 DT = 1e-5
 DIM = 2
+# Which 'gravity_kernels' kernel both solvers are compiled with, and its run
+# time parameters (see 'softening_length' and 'kernel_scale')
+GRAVITY_KERNEL = gravity_kernels.PLUMMER
+SOFTENING_LENGTH = 1e-3 ** 0.5
+KERNEL_SCALE = 0.25  # cutoff radius or screening length
 NUM_MAX_PARTICLE = 8192  # 2^13
 SHAPE_FACTOR = 1
 
-# Using this table to store all the information (pos, vel, mass) of particles
-# Currently using SoA memory model
-particle_pos = ti.Vector.field(n=DIM, dtype=ti.f32)
-particle_vel = ti.Vector.field(n=DIM, dtype=ti.f32)
-particle_mass = ti.field(dtype=ti.f32)
-particle_table = ti.root.dense(indices=ti.i, dimensions=NUM_MAX_PARTICLE)
-particle_table.place(particle_pos).place(particle_vel).place(particle_mass)
-num_particles = ti.field(dtype=ti.i32, shape=())
-
 # Quadtree related
 T_MAX_DEPTH = 1 * NUM_MAX_PARTICLE
 T_MAX_NODES = 4 * T_MAX_DEPTH
 LEAF = -1
 TREE = -2
 
-# Each node contains information about the node mass, the centroid position,
-# and the particle which it contains in ID
-node_mass = ti.field(ti.f32)
-node_centroid_pos = ti.Vector.field(DIM, ti.f32)
-node_particle_id = ti.field(ti.i32)
-node_children = ti.field(ti.i32)
-
-node_table = ti.root.dense(ti.i, T_MAX_NODES)
-# node_table.place(node_mass, node_particle_id, node_centroid_pos)
-node_table.place(node_particle_id, node_centroid_pos, node_mass)  # AoS here
-node_table.dense(indices={2: ti.jk, 3: ti.jkl}[DIM], dimensions=2).place(
-    node_children)  # ????
-node_table_len = ti.field(dtype=ti.i32, shape=())
-
-# Also a trash table
-trash_particle_id = ti.field(ti.i32)
-trash_base_parent = ti.field(ti.i32)
-trash_base_geo_center = ti.Vector.field(DIM, ti.f32)
-trash_base_geo_size = ti.field(ti.f32)
-trash_table = ti.root.dense(ti.i, T_MAX_DEPTH)
-trash_table.place(trash_particle_id)
-trash_table.place(trash_base_parent, trash_base_geo_size)
-trash_table.place(trash_base_geo_center)
-trash_table_len = ti.field(ti.i32, ())
-
-# ------ Per-project Timer Utils -------------------------------------------
-time_starts = ti.field(dtype=ti.i64, shape=NUM_MAX_PARTICLE)
-time_ends = ti.field(dtype=ti.i64, shape=NUM_MAX_PARTICLE)
+# Layout of the tree the traversals walk. 'build_tree' scatters the nodes in
+# insertion order, so it copies them once built ('relayout_tree') in breadth
+# or depth first order, the children of a node next to each other and the
+# centroids already divided by the masses
+LAYOUT_INSERTION = 0  # walk the node table as built
+LAYOUT_BFS = 1  # same order as the (queue based) walks visit nodes
+LAYOUT_DFS = 2
+TREE_LAYOUT = LAYOUT_BFS
+
+# Diagnostics, each one is a single scalar reduced on the device so only a
+# few numbers are ever copied back to the host
+DIAGNOSTICS_INTERVAL = 10  # compute every K steps, 0 to disable
+# The potential energy walks the tree from every particle in parallel, on
+# this many walkers, each one with its own queue
+POTENTIAL_WALKERS = 64
+
+
+def init(arch=ti.cpu, offline_cache=False, cache_path=None, timer=None):
+    """
+    Initialize Taichi and allocate all the fields. Nothing happens when the
+    module is imported, so call this first.
+
+    :param offline_cache: keep the compiled kernels on disk (in 'cache_path',
+    or Taichi's default location) so later runs skip compiling them
+    :param timer: whether to load the timer DLL, by default only if it exists
+    """
+    global particle_pos, particle_vel, particle_mass, num_particles, \
+        node_mass, node_centroid_pos, node_particle_id, node_children, \
+        node_table_len, packed_center, packed_mass, packed_particle_id, \
+        packed_first_child, packed_num_children, packed_source, packed_stack, \
+        packed_len, trash_particle_id, trash_base_parent, \
+        trash_base_geo_center, trash_base_geo_size, trash_table_len, \
+        diag_kinetic, diag_potential, diag_momentum, diag_angular_momentum, \
+        walk_parent, walk_geo_size, softening_length, kernel_scale, \
+        time_starts, time_ends
+    if taichi_setup.init_taichi(arch, offline_cache, cache_path, timer,
+                                TIMER_DLL):
+        timer_init()
+
+    # Using this table to store all the information (pos, vel, mass) of
+    # particles. Currently using SoA memory model
+    particle_pos = ti.Vector.field(n=DIM, dtype=ti.f32)
+    particle_vel = ti.Vector.field(n=DIM, dtype=ti.f32)
+    particle_mass = ti.field(dtype=ti.f32)
+    particle_table = ti.root.dense(ti.i, NUM_MAX_PARTICLE)
+    particle_table.place(particle_pos).place(particle_vel).place(
+        particle_mass)
+    num_particles = ti.field(dtype=ti.i32, shape=())
+
+    # Each node contains information about the node mass, the centroid
+    # position, and the particle which it contains in ID
+    node_mass = ti.field(ti.f32)
+    node_centroid_pos = ti.Vector.field(DIM, ti.f32)
+    node_particle_id = ti.field(ti.i32)
+    node_children = ti.field(ti.i32)
+
+    node_table = ti.root.dense(ti.i, T_MAX_NODES)
+    # node_table.place(node_mass, node_particle_id, node_centroid_pos)
+    node_table.place(node_particle_id, node_centroid_pos, node_mass)  # AoS
+    # 'ti.indices' was renamed to 'ti.axes' in newer Taichi versions
+    axes = ti.axes if hasattr(ti, 'axes') else ti.indices
+    node_table.dense(axes(*range(1, 1 + DIM)), 2).place(node_children)
+    node_table_len = ti.field(dtype=ti.i32, shape=())
+
+    # The tree relaid out by 'relayout_tree', AoS so that visiting a node
+    # touches a single cache line
+    packed_center = ti.Vector.field(DIM, ti.f32)
+    packed_mass = ti.field(ti.f32)
+    packed_particle_id = ti.field(ti.i32)
+    packed_first_child = ti.field(ti.i32)
+    packed_num_children = ti.field(ti.i32)
+    ti.root.dense(ti.i, T_MAX_NODES).place(
+        packed_center, packed_mass, packed_particle_id, packed_first_child,
+        packed_num_children)
+    # Only used while relaying out: the original node of every packed one,
+    # and the DFS stack
+    packed_source = ti.field(ti.i32, T_MAX_NODES)
+    packed_stack = ti.field(ti.i32, T_MAX_NODES)
+    packed_len = ti.field(ti.i32, ())
+
+    # Also a trash table
+    trash_particle_id = ti.field(ti.i32)
+    trash_base_parent = ti.field(ti.i32)
+    trash_base_geo_center = ti.Vector.field(DIM, ti.f32)
+    trash_base_geo_size = ti.field(ti.f32)
+    trash_table = ti.root.dense(ti.i, T_MAX_DEPTH)
+    trash_table.place(trash_particle_id)
+    trash_table.place(trash_base_parent, trash_base_geo_size)
+    trash_table.place(trash_base_geo_center)
+    trash_table_len = ti.field(ti.i32, ())
+
+    # f64, the drift they are there to catch is below f32 resolution
+    diag_kinetic = ti.field(ti.f64, ())
+    diag_potential = ti.field(ti.f64, ())
+    walk_parent = ti.field(ti.i32)
+    walk_geo_size = ti.field(ti.f32)
+    ti.root.dense(ti.i, POTENTIAL_WALKERS).dense(ti.j, T_MAX_DEPTH).place(
+        walk_parent, walk_geo_size)
+    diag_momentum = ti.Vector.field(DIM, ti.f32, ())
+    diag_angular_momentum = ti.field(ti.f32, ())
+
+    softening_length = ti.field(ti.f32, ())
+    kernel_scale = ti.field(ti.f32, ())
+
+    # ------ Per-project Timer Utils ---------------------------------------
+    time_starts = ti.field(dtype=ti.i64, shape=NUM_MAX_PARTICLE)
+    time_ends = ti.field(dtype=ti.i64, shape=NUM_MAX_PARTICLE)
+
+    softening_length[None] = SOFTENING_LENGTH
+    kernel_scale[None] = KERNEL_SCALE
 
 
 # --------------------------------------------------------------------------
@@ -222,6 +306,11 @@ def build_tree():
     well.
     :return:
     """
+    construct_tree()
+
+
+@ti.func
+def construct_tree():
     node_table_len[None] = 0
     trash_table_len[None] = 0
     alloc_node()
@@ -242,7 +331,10 @@ def build_tree():
                                   1.0)
 
         trash_id = 0
-        while trash_id < trash_table_len[None]:
+        # The table grows while it is emptied. Read through an atomic, with
+        # a plain load the optimizer (Taichi 1.7) keeps the length from
+        # before the loop and drops the particles moved to the table in it
+        while trash_id < ti.atomic_add(trash_table_len[None], 0):
             alloc_a_node_for_particle(trash_particle_id[trash_id],
                                       trash_base_parent[trash_id],
                                       trash_base_geo_center[trash_id],
@@ -257,6 +349,64 @@ def build_tree():
 
         particle_id = particle_id + 1
 
+    if ti.static(TREE_LAYOUT != LAYOUT_INSERTION):
+        relayout_tree()
+
+
+@ti.func
+def pack_children(i):
+    """
+    Append the children of the packed node 'i' to the packed table, next to
+    each other.
+    """
+    node = packed_source[i]
+    first = packed_len[None]
+    for which in ti.grouped(ti.ndrange(*([2] * DIM))):
+        child = node_children[node, which]
+        if child != LEAF:
+            k = packed_len[None]
+            packed_len[None] = k + 1
+            packed_source[k] = child
+            packed_mass[k] = node_mass[child]
+            packed_center[k] = node_centroid_pos[child] / node_mass[child]
+            packed_particle_id[k] = node_particle_id[child]
+    packed_first_child[i] = first
+    packed_num_children[i] = packed_len[None] - first
+
+
+@ti.func
+def relayout_tree():
+    """
+    Copy the node table into the packed one, in 'TREE_LAYOUT' order. The
+    root stays the node 0.
+    """
+    packed_len[None] = 1
+    packed_source[0] = 0
+    packed_mass[0] = node_mass[0]
+    packed_center[0] = node_centroid_pos[0] / max(node_mass[0], 1e-30)
+    packed_particle_id[0] = node_particle_id[0]
+
+    if ti.static(TREE_LAYOUT == LAYOUT_BFS):
+        # The packed table is its own queue
+        i = 0
+        while i < packed_len[None]:
+            pack_children(i)
+            i = i + 1
+    else:  # LAYOUT_DFS
+        packed_stack[0] = 0
+        stack_len = 1
+        while stack_len > 0:
+            stack_len = stack_len - 1
+            i = packed_stack[stack_len]
+            pack_children(i)
+            # Pushed in reverse, so the first child is visited first
+            k = packed_first_child[i] + packed_num_children[i] - 1
+            while k >= packed_first_child[i]:
+                if packed_particle_id[k] < 0:
+                    packed_stack[stack_len] = k
+                    stack_len = stack_len + 1
+                k = k - 1
+
 
 @ti.func
 def gravity_func(distance):
@@ -265,9 +415,23 @@ def gravity_func(distance):
     :param distance: the distance between things.
     :return:
     """
-    # --- The equation defined in the new n-body example
-    l2 = distance.norm_sqr() + 1e-3
-    return distance * (l2 ** ((-3) / 2))
+    # --- 'GRAVITY_KERNEL' is resolved at compile time, the Plummer one is
+    # the equation defined in the new n-body example
+    return gravity_kernels.gravity(GRAVITY_KERNEL, distance,
+                                   softening_length[None], kernel_scale[None])
+
+
+@ti.func
+def potential_func(distance):
+    """
+    The potential matching 'gravity_func', i.e. its negative gradient w.r.t.
+    the position where the potential is evaluated gives back the gravity.
+    :param distance: the distance between things.
+    :return: the (per unit mass) potential, a scalar
+    """
+    return gravity_kernels.potential(GRAVITY_KERNEL, distance,
+                                     softening_length[None],
+                                     kernel_scale[None])
 
 
 @ti.func
@@ -318,6 +482,54 @@ def get_tree_gravity_at(position):
     return acc
 
 
+@ti.func
+def get_packed_sum_at(position, self_id, func: ti.template(), ret):
+    """
+    The walk of 'get_tree_gravity_at' over the packed tree, adding up
+    'mass * func(distance)' to 'ret' (particle 'self_id' is skipped).
+    Particles are added as soon as their parent is opened instead of being
+    queued first, which gives the same sum.
+    """
+    trash_table_len[None] = 0
+    trash_id = alloc_trash()
+    trash_base_parent[trash_id] = 0
+    trash_base_geo_size[trash_id] = 1.0
+
+    if packed_particle_id[0] >= 0:  # a single particle
+        trash_table_len[None] = 0
+        if packed_particle_id[0] != self_id:
+            ret += packed_mass[0] * func(packed_center[0] - position)
+
+    trash_id = 0
+    while trash_id < trash_table_len[None]:
+        # ----------- Timer code --------------------
+        time_starts[trash_id] = get_time_nanosec()
+        # -------------------------------------------
+
+        parent = trash_base_parent[trash_id]
+        parent_geo_size = trash_base_geo_size[trash_id]
+
+        first = packed_first_child[parent]
+        for child in range(first, first + packed_num_children[parent]):
+            distance = packed_center[child] - position
+            particle_id = packed_particle_id[child]
+            if particle_id >= 0 or distance.norm_sqr() > \
+                    SHAPE_FACTOR ** 2 * parent_geo_size ** 2:
+                if particle_id != self_id:
+                    ret += packed_mass[child] * func(distance)
+            else:
+                new_trash_id = alloc_trash()
+                trash_base_parent[new_trash_id] = child
+                trash_base_geo_size[new_trash_id] = parent_geo_size * 0.5
+
+        # ----------- Timer code ------------------
+        time_ends[trash_id] = get_time_nanosec()
+        # -----------------------------------------
+        trash_id = trash_id + 1
+
+    return ret
+
+
 @ti.func
 def get_raw_gravity_at(pos):
     acc = particle_pos[0] * 0
@@ -326,6 +538,73 @@ def get_raw_gravity_at(pos):
     return acc
 
 
+@ti.func
+def get_tree_potential_at(walker, position, self_id):
+    """
+    Same traversal as 'get_tree_gravity_at' (or 'get_packed_sum_at'), but
+    sums up the potential instead, queueing the nodes to open in the queue
+    of 'walker' so that several walks can run at once. The particle itself
+    ('self_id') is skipped.
+    """
+    phi = 0.0
+    walk_parent[walker, 0] = 0
+    walk_geo_size[walker, 0] = 1.0
+    queue_len = 1
+    if ti.static(TREE_LAYOUT != LAYOUT_INSERTION):
+        if packed_particle_id[0] >= 0:  # a single particle
+            queue_len = 0
+            if packed_particle_id[0] != self_id:
+                phi += packed_mass[0] * potential_func(packed_center[0] -
+                                                       position)
+
+    head = 0
+    while head < queue_len:
+        parent = walk_parent[walker, head]
+        parent_geo_size = walk_geo_size[walker, head]
+
+        if ti.static(TREE_LAYOUT != LAYOUT_INSERTION):
+            first = packed_first_child[parent]
+            for child in range(first, first + packed_num_children[parent]):
+                distance = packed_center[child] - position
+                particle_id = packed_particle_id[child]
+                if particle_id >= 0 or distance.norm_sqr() > \
+                        SHAPE_FACTOR ** 2 * parent_geo_size ** 2:
+                    if particle_id != self_id:
+                        phi += packed_mass[child] * potential_func(distance)
+                else:
+                    assert queue_len < T_MAX_DEPTH
+                    walk_parent[walker, queue_len] = child
+                    walk_geo_size[walker, queue_len] = parent_geo_size * 0.5
+                    queue_len = queue_len + 1
+        else:
+            particle_id = node_particle_id[parent]
+            if particle_id >= 0:
+                if particle_id != self_id:
+                    distance = particle_pos[particle_id] - position
+                    phi += particle_mass[particle_id] * potential_func(
+                        distance)
+
+            else:  # TREE or LEAF
+                for which in ti.grouped(ti.ndrange(*([2] * DIM))):
+                    child = node_children[parent, which]
+                    if child == LEAF:
+                        continue
+                    node_center = node_centroid_pos[child] / node_mass[child]
+                    distance = node_center - position
+                    if distance.norm_sqr() > \
+                            SHAPE_FACTOR ** 2 * parent_geo_size ** 2:
+                        phi += node_mass[child] * potential_func(distance)
+                    else:
+                        assert queue_len < T_MAX_DEPTH
+                        walk_parent[walker, queue_len] = child
+                        walk_geo_size[walker, queue_len] = \
+                            parent_geo_size * 0.5
+                        queue_len = queue_len + 1
+        head = head + 1
+
+    return phi
+
+
 # Helper functions I lifted from 'taichi_glsl'
 @ti.func
 def boundReflect(pos, vel, pmin=0, pmax=1, gamma=1, gamma_perpendicular=1):
@@ -357,9 +636,25 @@ def boundReflect(pos, vel, pmin=0, pmax=1, gamma=1, gamma_perpendicular=1):
 # The O(NlogN) kernel using quadtree
 @ti.kernel
 def substep_tree():
+    kick_tree()
+    for i in range(num_particles[None]):
+        particle_pos[i] += particle_vel[i] * DT
+
+
+@ti.func
+def kick_tree():
+    """
+    The velocity update of 'substep_tree', one particle after another since
+    the traversal uses the trash table as its stack.
+    """
     particle_id = 0
     while particle_id < num_particles[None]:
-        acceleration = get_tree_gravity_at(particle_pos[particle_id])
+        acceleration = particle_pos[0] * 0
+        if ti.static(TREE_LAYOUT != LAYOUT_INSERTION):
+            acceleration = get_packed_sum_at(particle_pos[particle_id], -1,
+                                             gravity_func, acceleration)
+        else:
+            acceleration = get_tree_gravity_at(particle_pos[particle_id])
         particle_vel[particle_id] += acceleration * DT
         # well... seems our tree inserter will break if particle out-of-bound:
         particle_vel[particle_id] = boundReflect(particle_pos[particle_id],
@@ -367,9 +662,6 @@ def substep_tree():
                                                  0, 1)
         particle_id = particle_id + 1
 
-    for i in range(num_particles[None]):
-        particle_pos[i] += particle_vel[i] * DT
-
 
 # The O(N^2) kernel algorithm
 @ti.kernel
@@ -383,6 +675,64 @@ def substep_raw():
         particle_pos[i] += particle_vel[i] * DT
 
 
+@ti.kernel
+def compute_moments():
+    """
+    Kinetic energy, total momentum and angular momentum (around the center of
+    the box) as parallel reductions over the particle table.
+    """
+    diag_kinetic[None] = 0
+    diag_momentum[None] = particle_pos[0] * 0
+    diag_angular_momentum[None] = 0
+    for i in range(num_particles[None]):
+        m = particle_mass[i]
+        v = particle_vel[i]
+        r = particle_pos[i] - 0.5
+        diag_kinetic[None] += ti.cast(0.5 * m * v.norm_sqr(), ti.f64)
+        diag_momentum[None] += m * v
+        diag_angular_momentum[None] += m * (r[0] * v[1] - r[1] * v[0])
+
+
+@ti.kernel
+def compute_tree_potential():
+    """
+    Tree approximated potential energy. Needs an up-to-date tree, i.e. call
+    'build_tree()' first. The walkers run in parallel, each one taking every
+    POTENTIAL_WALKERS-th particle.
+    """
+    diag_potential[None] = 0
+    for walker in range(POTENTIAL_WALKERS):
+        potential = ti.cast(0, ti.f64)
+        particle_id = walker
+        while particle_id < num_particles[None]:
+            phi = get_tree_potential_at(walker, particle_pos[particle_id],
+                                        particle_id)
+            # each pair is visited twice
+            potential += ti.cast(0.5 * particle_mass[particle_id] * phi,
+                                 ti.f64)
+            particle_id = particle_id + POTENTIAL_WALKERS
+        diag_potential[None] += potential
+
+
+def get_diagnostics():
+    """
+    Run the diagnostic reductions and fetch the resulting scalars.
+    :return: dict of kinetic/potential/total energy, momentum and angular
+    momentum
+    """
+    compute_moments()
+    compute_tree_potential()
+    kinetic = diag_kinetic[None]
+    potential = diag_potential[None]
+    return {
+        'kinetic': kinetic,
+        'potential': potential,
+        'energy': kinetic + potential,
+        'momentum': [diag_momentum[None][k] for k in range(DIM)],
+        'angular_momentum': diag_angular_momentum[None],
+    }
+
+
 @ti.kernel
 def initialize(num_p: ti.i32):
     """
@@ -403,11 +753,143 @@ def initialize(num_p: ti.i32):
         #     [ti.random() * 1.0, ti.random() * 1.0])
 
 
+def warmup():
+    """
+    Compile the solver kernels before the first step by running them on an
+    empty system. The particles, if any, are left untouched. With the offline
+    cache this mostly loads them from disk.
+    """
+    n = num_particles[None]
+    num_particles[None] = 0
+    build_tree()
+    substep_tree()
+    substep_raw()
+    compute_moments()
+    compute_tree_potential()
+    num_particles[None] = n
+
+
+# ------------------------------ Embedding API -------------------------------
+
+# External (NumPy) array kernel argument, 'ti.ext_arr' on older Taichi
+if hasattr(ti, 'types') and hasattr(ti.types, 'ndarray'):
+    ndarray = ti.types.ndarray
+else:
+    ndarray = ti.ext_arr
+
+SOLVER_TREE = 'tree'
+SOLVER_RAW = 'raw'
+
+
+@ti.kernel
+def load_particle_table(n: ti.i32, pos: ndarray(), vel: ndarray(),
+                        mass: ndarray()):
+    for i in range(n):
+        for k in ti.static(range(DIM)):
+            particle_pos[i][k] = pos[i, k]
+            particle_vel[i][k] = vel[i, k]
+        particle_mass[i] = mass[i]
+    num_particles[None] = n
+
+
+@ti.kernel
+def store_particle_table(n: ti.i32, pos: ndarray(), vel: ndarray(),
+                         mass: ndarray()):
+    for i in range(n):
+        for k in ti.static(range(DIM)):
+            pos[i, k] = particle_pos[i][k]
+            vel[i, k] = particle_vel[i][k]
+        mass[i] = particle_mass[i]
+
+
+@ti.kernel
+def run_tree(steps: ti.i32):
+    """
+    'steps' times 'build_tree' then 'substep_tree', in a single launch. The
+    position update is serial here too, which costs little next to the
+    tree walks.
+    """
+    step = 0
+    while step < steps:
+        construct_tree()
+        kick_tree()
+        for i in range(num_particles[None]):
+            particle_pos[i] += particle_vel[i] * DT
+        step = step + 1
+
+
+class Simulation:
+    """
+    NumPy in and out over the solver, to drive it from other code without
+    touching the fields. The fields are module level, so there is only one
+    simulation at a time.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: passed to 'init'
+        """
+        init(**kwargs)
+        # Reused by every 'state', so it allocates nothing
+        self.pos = np.zeros((NUM_MAX_PARTICLE, DIM), dtype=np.float32)
+        self.vel = np.zeros((NUM_MAX_PARTICLE, DIM), dtype=np.float32)
+        self.mass = np.zeros(NUM_MAX_PARTICLE, dtype=np.float32)
+
+    def load(self, positions, velocities, masses):
+        """
+        Replace all the particles, copied in a single kernel.
+
+        :param positions: (n, DIM) positions, in [0, 1]
+        :param velocities: (n, DIM) velocities
+        :param masses: (n,) masses
+        """
+        pos, vel, mass = (np.ascontiguousarray(a, dtype=np.float32)
+                          for a in (positions, velocities, masses))
+        n = len(mass)
+        if n > NUM_MAX_PARTICLE:
+            raise ValueError('{} particles do not fit in NUM_MAX_PARTICLE = '
+                             '{}'.format(n, NUM_MAX_PARTICLE))
+        if pos.shape != (n, DIM) or vel.shape != (n, DIM):
+            raise ValueError('expected ({0}, {1}) positions and velocities, '
+                             'got {2} and {3}'.format(n, DIM, pos.shape,
+                                                      vel.shape))
+        load_particle_table(n, pos, vel, mass)
+
+    def step(self, n=1, solver=SOLVER_TREE):
+        """
+        Advance 'n' steps of 'DT'. The tree solver runs them all in one
+        kernel launch. The raw one launches 'substep_raw' every step, since
+        looping inside the kernel would serialize its parallel loops.
+
+        :param solver: SOLVER_TREE or SOLVER_RAW
+        """
+        if solver == SOLVER_TREE:
+            run_tree(n)
+        elif solver == SOLVER_RAW:
+            for _ in range(n):
+                substep_raw()
+        else:
+            raise ValueError('unknown solver {!r}'.format(solver))
+
+    def state(self):
+        """
+        Taichi fields cannot be viewed from NumPy, so the particles are
+        copied once into buffers owned by the simulation, and views of them
+        are returned. They are overwritten by the next 'state', copy them to
+        keep them.
+
+        :return: positions, velocities and masses
+        """
+        n = num_particles[None]
+        store_particle_table(n, self.pos, self.vel, self.mass)
+        return self.pos[:n], self.vel[:n], self.mass[:n]
+
+
 if __name__ == '__main__':
+    init()  # offline_cache=True to reuse the kernels of earlier runs
     gui = ti.GUI('N-body Star', res=RES)
 
     initialize(8192)  #
-    timer_init()
 
     for step in range(1):
         # while gui.running:
@@ -419,8 +901,11 @@ if __name__ == '__main__':
         # for _ in range(10):
         # Main computation
         build_tree()
+        if DIAGNOSTICS_INTERVAL and step % DIAGNOSTICS_INTERVAL == 0:
+            print(f'step {step}: {get_diagnostics()}')
         substep_tree()
         # substep_raw()
 
     # print_results(f'nbody_out/t_{step:05d}_plt.png')
-    print_results(None)
+    if timer_loaded:  # all zeros otherwise
+        print_results(None)
@@ -114,6 +114,22 @@ build_time_ends = ti.field(dtype=ti.i64, shape=NUM_MAX_PARTICLE)
 get_time_starts = ti.field(dtype=ti.i64, shape=NUM_MAX_PARTICLE)
 get_time_ends = ti.field(dtype=ti.i64, shape=NUM_MAX_PARTICLE)
 
+# ------ Offscreen frames --------------------------------------------------
+# Particles are splatted straight into an image field, so frames can be
+# written without a GUI (or copying the particles to the host). Either as
+# plain dots like 'gui.circles' did, or as the log tonemapped number of
+# particles (or their mass) covering each pixel
+SPLAT_CIRCLES = 0
+SPLAT_DENSITY = 1
+SPLAT_MASS = 2
+SPLAT_MODE = SPLAT_DENSITY
+SPLAT_RADIUS = 2
+FRAME_COLOR = (0xfb / 255, 0xfc / 255, 0xbf / 255)
+
+frame_accum = ti.field(dtype=ti.f32, shape=RES)
+frame_max = ti.field(dtype=ti.f32, shape=())
+frame_pixels = ti.Vector.field(3, dtype=ti.u8, shape=RES)
+
 
 # --------------------------------------------------------------------------
 
@@ -388,6 +404,50 @@ def substep_raw():
         particle_pos[i] += particle_vel[i] * DT
 
 
+@ti.kernel
+def splat_particles(mode: ti.template()):
+    for u, v in frame_accum:
+        frame_accum[u, v] = 0
+    for i in range(num_particles[None]):
+        center = ti.cast(ti.floor(particle_pos[i] * ti.Vector(RES)), ti.i32)
+        weight = 1.0
+        if ti.static(mode == SPLAT_MASS):
+            weight = particle_mass[i]
+        for du in ti.static(range(-SPLAT_RADIUS, SPLAT_RADIUS + 1)):
+            for dv in ti.static(range(-SPLAT_RADIUS, SPLAT_RADIUS + 1)):
+                if ti.static(du * du + dv * dv <= SPLAT_RADIUS ** 2):
+                    u, v = center[0] + du, center[1] + dv
+                    if 0 <= u < RES[0] and 0 <= v < RES[1]:
+                        if ti.static(mode == SPLAT_CIRCLES):
+                            frame_accum[u, v] = 1
+                        else:
+                            frame_accum[u, v] += weight
+
+
+@ti.kernel
+def tonemap_frame(mode: ti.template()):
+    frame_max[None] = 0
+    for u, v in frame_accum:
+        ti.atomic_max(frame_max[None], frame_accum[u, v])
+    for u, v in frame_accum:
+        value = frame_accum[u, v]
+        if ti.static(mode != SPLAT_CIRCLES):
+            value = ti.log(1 + value) / ti.log(1 + max(frame_max[None], 1e-6))
+        color = ti.Vector(FRAME_COLOR) * min(value, 1.0) * 255
+        frame_pixels[u, v] = ti.cast(color, ti.u8)
+
+
+def write_frame(filename, mode=SPLAT_MODE):
+    """
+    Render the particles offscreen and save them as an image.
+    """
+    splat_particles(mode)
+    tonemap_frame(mode)
+    # moved to 'ti.tools' in newer Taichi versions
+    imwrite = ti.imwrite if hasattr(ti, 'imwrite') else ti.tools.imwrite
+    imwrite(frame_pixels.to_numpy(), filename)
+
+
 @ti.kernel
 def initialize(num_p: ti.i32):
     """
@@ -409,17 +469,18 @@ def initialize(num_p: ti.i32):
 
 
 if __name__ == '__main__':
-    gui = ti.GUI('N-body Star', res=RES)
+    # gui = ti.GUI('N-body Star', res=RES)
 
     initialize(8192)  #
     timer_init()
 
     for step in range(50):
         # while gui.running:
-        gui.circles(particle_pos.to_numpy(), radius=2, color=0xfbfcbf)
+        # gui.circles(particle_pos.to_numpy(), radius=2, color=0xfbfcbf)
         filename = f'nbody_out/t_{step:05d}.png'
         # print(f't {step} is recorded in {filename}')
-        gui.show(filename)
+        # gui.show(filename)
+        write_frame(filename)
 
         for _ in range(10):
             # Main computation
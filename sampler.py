@@ -0,0 +1,109 @@
+""" Low discrepancy sampling for the path tracer.
+
+Owen scrambled Sobol points, following 'Practical Hash-based Owen Scrambling'
+(Burley 2020): every pair of dimensions uses the first two Sobol dimensions,
+decorrelated from the other pairs (and other pixels) by shuffling the sample
+index and scrambling the points with hashes of (pixel, dimension).
+
+https://jcgt.org/published/0009/04/01/
+"""
+import taichi as ti
+
+
+def _as_i32(x):
+    """
+    Literals are i32 by default, so write u32 constants as the i32 with the
+    same bits and cast them.
+    """
+    return x - (1 << 32) if x >= 1 << 31 else x
+
+
+LOWBIAS_MUL = _as_i32(0x7feb352d), _as_i32(0x846ca68b)
+GOLDEN_RATIO = _as_i32(0x9e3779b9)
+LAINE_KARRAS_MUL = (_as_i32(0x6c50b47c), _as_i32(0xb82f1e52),
+                    _as_i32(0xc7afe638), _as_i32(0x8d22f6e6))
+
+
+@ti.func
+def u32(x):
+    return ti.cast(x, ti.u32)
+
+
+@ti.func
+def reverse_bits(x):
+    x = ((x >> 1) & u32(0x55555555)) | ((x & u32(0x55555555)) << 1)
+    x = ((x >> 2) & u32(0x33333333)) | ((x & u32(0x33333333)) << 2)
+    x = ((x >> 4) & u32(0x0F0F0F0F)) | ((x & u32(0x0F0F0F0F)) << 4)
+    x = ((x >> 8) & u32(0x00FF00FF)) | ((x & u32(0x00FF00FF)) << 8)
+    return (x >> 16) | (x << 16)
+
+
+@ti.func
+def hash_u32(x):
+    # https://nullprogram.com/blog/2018/07/31/ (lowbias32)
+    x ^= x >> 16
+    x *= u32(LOWBIAS_MUL[0])
+    x ^= x >> 15
+    x *= u32(LOWBIAS_MUL[1])
+    x ^= x >> 16
+    return x
+
+
+@ti.func
+def hash_combine(seed, v):
+    return seed ^ (hash_u32(v) + u32(GOLDEN_RATIO) + (seed << 6) +
+                   (seed >> 2))
+
+
+@ti.func
+def laine_karras_permutation(x, seed):
+    x += seed
+    for k in ti.static(range(4)):
+        x ^= x * u32(LAINE_KARRAS_MUL[k])
+    return x
+
+
+@ti.func
+def nested_uniform_scramble(x, seed):
+    x = reverse_bits(x)
+    x = laine_karras_permutation(x, seed)
+    return reverse_bits(x)
+
+
+@ti.func
+def sobol_2d(index):
+    """
+    :return: the first two dimensions of the Sobol sequence, as u32
+    """
+    x = reverse_bits(index)
+    y = u32(0)
+    v = u32(1) << 31
+    i = index
+    while i != 0:
+        if i & 1:
+            y ^= v
+        i >>= 1
+        v ^= v >> 1
+    return x, y
+
+
+@ti.func
+def to_unit_float(x):
+    return ti.cast(x >> 8, ti.f32) * (1.0 / (1 << 24))
+
+
+@ti.func
+def sobol_sample_2d(pixel, index, dim):
+    """
+    :param pixel: any integer identifying the pixel
+    :param index: the sample number within the pixel
+    :param dim: which pair of dimensions is sampled (e.g. 0 for the pixel
+    jitter, 1 + bounce for the bounce direction)
+    :return: a 2D point in [0, 1)^2
+    """
+    seed = hash_combine(hash_u32(u32(pixel)), u32(dim))
+    shuffled = nested_uniform_scramble(u32(index), seed)
+    x, y = sobol_2d(shuffled)
+    x = nested_uniform_scramble(x, hash_combine(seed, u32(1)))
+    y = nested_uniform_scramble(y, hash_combine(seed, u32(2)))
+    return ti.Vector([to_unit_float(x), to_unit_float(y)])
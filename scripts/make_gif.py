@@ -1,48 +1,76 @@
-import imageio
-from os import listdir, remove
+import argparse
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count, listdir
 from os.path import isfile, join, dirname
+
+import imageio
 import numpy as np
 
 PATH = join(dirname(__file__), '../nbody_out')
 
-images = [f for f in listdir(PATH) if isfile(join(PATH, f))]
+# 't_00042.png' is the simulation at step 42 and 't_00042_plt.png' its plot
+FRAME_NAME = re.compile(r't_(\d+)(_plt)?\.png$')
 
-raw_images = [f for f in images if '_plt' not in f]
-plt_images = [f for f in images if '_plt' in f]
 
+def find_frame_pairs(path):
+    """
+    :return: (raw, plot) file name pairs, in step order. Steps missing either
+    one of the two are skipped
+    """
+    raw_images, plt_images = {}, {}
+    for f in listdir(path):
+        match = FRAME_NAME.match(f)
+        if match is None or not isfile(join(path, f)):
+            continue
+        images = plt_images if match.group(2) else raw_images
+        images[int(match.group(1))] = f
+    steps = sorted(raw_images.keys() & plt_images.keys())
+    return [(raw_images[step], plt_images[step]) for step in steps]
 
-def make_gif(out_name, source_pngs):
-    ret = out_name + '.gif'
-    with imageio.get_writer(ret, mode='I') as writer:
-        for filename in source_pngs:
-            image = imageio.imread(join(PATH, filename))
-            writer.append_data(image)
-    return ret
 
+def to_rgb(image):
+    if image.ndim == 2:
+        image = np.stack([image] * 3, axis=-1)
+    return image[:, :, :3]
 
-def concatenate_gifs(lhs, rhs):
-    gif1 = imageio.get_reader(lhs)
-    gif2 = imageio.get_reader(rhs)
-    # If they don't have the same number of frame take the shorter
-    number_of_frames = min(gif1.get_length(), gif2.get_length())
 
-    # Create writer object
-    new_gif = imageio.get_writer('output.gif')
+def compose(path, pair):
+    """
+    Decode both images of a pair and put them side by side (the shorter one
+    is padded with black at the bottom).
+    """
+    lhs, rhs = (to_rgb(imageio.imread(join(path, f))) for f in pair)
+    height = max(lhs.shape[0], rhs.shape[0])
+    lhs, rhs = (np.pad(image, ((0, height - image.shape[0]), (0, 0), (0, 0)))
+                for image in (lhs, rhs))
+    return np.hstack((lhs, rhs))
 
-    for frame_number in range(number_of_frames):
-        img1 = gif1.get_next_data()
-        img2 = gif2.get_next_data()
-        # here is the magic
-        new_image = np.hstack((img1, img2))
-        new_gif.append_data(new_image)
 
-    gif1.close()
-    gif2.close()
-    new_gif.close()
+def make_gif(out_name, path, workers):
+    pairs = find_frame_pairs(path)
+    with ThreadPoolExecutor(workers) as pool, \
+            imageio.get_writer(out_name, mode='I') as writer:
+        # Only keep a few frames ahead of the encoder, so memory stays
+        # bounded however long the run is
+        pending = deque()
+        for pair in pairs:
+            pending.append(pool.submit(compose, path, pair))
+            if len(pending) >= 2 * workers:
+                writer.append_data(pending.popleft().result())
+        while pending:
+            writer.append_data(pending.popleft().result())
+    return len(pairs)
 
 
-lhs = make_gif("mygif1", raw_images)
-rhs = make_gif("mygif2", plt_images)
-concatenate_gifs(lhs, rhs)
-remove(lhs)
-remove(rhs)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Put the frames and plots of an N-body run side by side '
+                    'in a GIF')
+    parser.add_argument('--input', default=PATH)
+    parser.add_argument('--output', default='output.gif')
+    parser.add_argument('--workers', type=int, default=cpu_count() or 1)
+    args = parser.parse_args()
+    frames = make_gif(args.output, args.input, args.workers)
+    print('{} frames written to {}'.format(frames, args.output))
@@ -1,55 +1,159 @@
+import argparse
+import os
+
 import numpy as np
 import matplotlib.pyplot as plt
 
-# Load ready computed results
-with open('test.npy', 'rb') as f:
-    arr = np.load(f)
-
-averaged_arr = np.mean(arr, axis=0)
-
-# # Remove outliers based on some deviation
-mean = np.mean(averaged_arr)
-standard_deviation = np.std(averaged_arr)
-distance_from_mean = abs(averaged_arr - mean)
-max_deviations = 2
-# not_outlier = distance_from_mean < max_deviations * standard_deviation
-# no_outliers = averaged_arr[not_outlier]
-
-# new_arr = np.zeros((720, 1280))
-
-averaged_arr = np.clip(averaged_arr, 0, 25000)
-
-# averaged_arr /= np.max(np.abs(averaged_arr), axis=0)
-# averaged_arr /= np.max(np.abs(averaged_arr), axis=0)
-# averaged_arr *= 255
-
-fig, ax = plt.subplots()
-im = ax.imshow(np.rot90(averaged_arr))
-plt.savefig('final_out/sdf_heat.png')
-
-# plt.show()
-
-# # for i in range(1280):
-# #     for j in range(720):
-# #         new_arr[i, j] =
-#
-# #
-# # print(no_outliers.shape)
-# # print(no_outliers)
-# # print(np.min(no_outliers))
-# # print(np.max(no_outliers))
-# #
-# # # n, bins, patches = plt.hist(no_outliers.flatten(), 200, alpha=0.75)
-#
-# print(averaged_arr.shape)
-# print(np.max(averaged_arr))
-# print(np.min(averaged_arr))
-#
-# fig, axs = plt.subplots()
-# axs.hist2d(averaged_arr[:, 0], averaged_arr[:, 1], bins=200,
-#            range=[[0, 25000], [0, 25000]])
-#
-# # n, bins, patches = plt.hist2d(averaged_arr[:, 0], averaged_arr[:, 1], 200)
-#
-# # plt.savefig('final_out/sdf2d_100_avg_norm.png')
-# plt.show()
+# Color scale limit of the heatmaps, the statistics use the full range
+MAX_TIME = 25000
+# Log spaced over the [min, max] of the capture, so the tails are resolved
+HIST_BINS = 200
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Analyse per pixel timings captured by sdf_renderer')
+    parser.add_argument('input', nargs='?', default='test.npy',
+                        help='(frames, width, height) .npy capture')
+    parser.add_argument('--output', default='final_out',
+                        help='directory the plots are written to')
+    parser.add_argument('--chunk', type=int, default=16,
+                        help='number of frames read at once')
+    parser.add_argument('--tile', type=int, default=16,
+                        help='tile size of the per tile aggregates')
+    return parser.parse_args()
+
+
+def reduce_frames(arr, chunk):
+    """
+    Reduce over the frames of 'arr' 'chunk' frames at a time, so only that
+    many frames are ever in memory (with 'mmap_mode' the rest stays on disk).
+
+    :return: per pixel mean, standard deviation, min and max
+    """
+    frame_shape = arr.shape[1:]
+    total = np.zeros(frame_shape)
+    total_sq = np.zeros(frame_shape)
+    low = np.full(frame_shape, np.inf)
+    high = np.full(frame_shape, -np.inf)
+    for start in range(0, arr.shape[0], chunk):
+        frames = np.asarray(arr[start:start + chunk], dtype=np.float64)
+        total += frames.sum(axis=0)
+        total_sq += (frames * frames).sum(axis=0)
+        np.minimum(low, frames.min(axis=0), out=low)
+        np.maximum(high, frames.max(axis=0), out=high)
+    n = arr.shape[0]
+    mean = total / n
+    std = np.sqrt(np.maximum(total_sq / n - mean * mean, 0))
+    return mean, std, low, high
+
+
+def histogram_edges(low, high):
+    """
+    :return: HIST_BINS log spaced bins covering [low, high] (times below
+    1 ns share the first bin)
+    """
+    low = max(low, 1)
+    return np.geomspace(low, max(high, low + 1), HIST_BINS + 1)
+
+
+def histogram_frames(arr, chunk, edges):
+    """
+    Histogram of all the samples of 'arr', read 'chunk' frames at a time
+    like 'reduce_frames'.
+    """
+    hist = np.zeros(len(edges) - 1, dtype=np.int64)
+    for start in range(0, arr.shape[0], chunk):
+        frames = np.asarray(arr[start:start + chunk], dtype=np.float64)
+        hist += np.histogram(np.clip(frames, edges[0], edges[-1]), edges)[0]
+    return hist
+
+
+def histogram_percentiles(hist, edges, percentiles):
+    """
+    Percentiles of all the samples, read from their histogram (interpolated
+    within the bins, so only about as precise as the bin width).
+    """
+    cumulative = np.cumsum(hist) / hist.sum()
+    ret = []
+    for p in percentiles:
+        i = min(np.searchsorted(cumulative, p / 100), len(hist) - 1)
+        below = cumulative[i - 1] if i else 0.0
+        frac = (p / 100 - below) / max(cumulative[i] - below, 1e-12)
+        # geometric, the bins are log spaced
+        ret.append(edges[i] * (edges[i + 1] / edges[i]) ** frac)
+    return ret
+
+
+def tile_aggregates(image, tile):
+    """
+    :return: mean and max of 'image' over each tile x tile block (partial
+    tiles at the borders included)
+    """
+    w, h = image.shape
+    tiles_x, tiles_y = -(-w // tile), -(-h // tile)
+    padded = np.full((tiles_x * tile, tiles_y * tile), np.nan)
+    padded[:w, :h] = image
+    blocks = padded.reshape(tiles_x, tile, tiles_y, tile)
+    return np.nanmean(blocks, axis=(1, 3)), np.nanmax(blocks, axis=(1, 3))
+
+
+def save_heatmap(image, title, path):
+    fig, ax = plt.subplots()
+    im = ax.imshow(np.rot90(np.clip(image, 0, MAX_TIME)))
+    ax.set_title(title)
+    fig.colorbar(im, ax=ax)
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def save_histogram(hist, edges, title, path):
+    fig, ax = plt.subplots()
+    ax.stairs(hist, edges, fill=True, alpha=0.75)
+    ax.set_xscale('log')
+    ax.set_title(title)
+    ax.set_xlabel('ns')
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output, exist_ok=True)
+
+    # Load ready computed results, without reading them all into memory
+    arr = np.load(args.input, mmap_mode='r')
+    mean, std, low, high = reduce_frames(arr, args.chunk)
+    edges = histogram_edges(low.min(), high.max())
+    hist = histogram_frames(arr, args.chunk, edges)
+
+    print('{} frames of {}x{}'.format(*arr.shape))
+    print('mean {:.1f} ns, std {:.1f} ns, min {} ns, max {} ns'.format(
+        mean.mean(), std.mean(), low.min(), high.max()))
+    for p, value in zip(PERCENTILES,
+                        histogram_percentiles(hist, edges, PERCENTILES)):
+        print('  p{:<3} {:.0f} ns (all samples)'.format(p, value))
+    for p, value in zip(PERCENTILES, np.percentile(mean, PERCENTILES)):
+        print('  p{:<3} {:.0f} ns (per pixel means)'.format(p, value))
+
+    tile_mean, tile_max = tile_aggregates(mean, args.tile)
+    np.savez(os.path.join(args.output, 'sdf_stats.npz'), mean=mean, std=std,
+             min=low, max=high, hist=hist, hist_edges=edges,
+             tile_mean=tile_mean, tile_max=tile_max)
+
+    save_heatmap(mean, 'mean', os.path.join(args.output, 'sdf_heat.png'))
+    save_heatmap(std, 'standard deviation',
+                 os.path.join(args.output, 'sdf_heat_std.png'))
+    save_heatmap(tile_mean, 'mean per {0}x{0} tile'.format(args.tile),
+                 os.path.join(args.output, 'sdf_heat_tiles.png'))
+    save_histogram(hist, edges, 'all samples',
+                   os.path.join(args.output, 'sdf_hist.png'))
+    save_histogram(np.histogram(np.clip(mean, edges[0], edges[-1]),
+                                edges)[0], edges,
+                   'per pixel means',
+                   os.path.join(args.output, 'sdf_hist_mean.png'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+""" Scene description for the SDF renderer.
+
+A scene is a JSON (or YAML, if PyYAML is installed) file listing the camera,
+the light and a list of objects. Each object has a 'shape', which is a tree of
+primitives and CSG operations, and a 'material':
+
+    primitives: sphere (center, radius), box (center, half_size),
+                cylinder (center, radius, half_height, Y axis aligned),
+                plane (normal, offset)
+    operations: union (children), intersection (children),
+                subtraction (children, the first minus the others),
+                nested (child, frequency, thickness)
+    materials:  stripes, diffuse (albedo)
+
+See 'scenes/default.json'. 'compile_scene' turns a scene into 'ti.func's in
+which the whole tree is unrolled with 'ti.static', so there is no
+interpretation left at run time.
+"""
+import json
+
+import taichi as ti
+
+inf = 1e10
+
+
+def load_scene(path):
+    """
+    :param path: a .json, .yaml or .yml scene file
+    :return: the scene as a dict
+    """
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('PyYAML is needed to load ' + path)
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+# ----------------------------- Primitives ---------------------------------
+
+@ti.func
+def nested(f, frequency, thickness):
+    """
+    Turn the inside of a shape into nested shells, 'frequency' of them per
+    unit length.
+    """
+    f = f * frequency
+    i = int(f)
+    if f < 0:
+        if i % 2 == 1:
+            f -= ti.floor(f)
+        else:
+            f = ti.floor(f) + 1 - f
+    f = (f - thickness) / frequency
+    return f
+
+
+# https://www.iquilezles.org/www/articles/distfunctions/distfunctions.htm
+@ti.func
+def sphere_sdf(o, center, radius):
+    return (o - center).norm() - radius
+
+
+@ti.func
+def plane_sdf(o, normal, offset):
+    return o.dot(normal) + offset
+
+
+@ti.func
+def box_sdf(o, center, half_size):
+    q = ti.abs(o - center) - half_size
+    return ti.Vector([max(0, q[0]), max(0, q[1]),
+                      max(0, q[2])]).norm() + min(q.max(), 0)
+
+
+@ti.func
+def cylinder_sdf(o, center, radius, half_height):
+    O = o - center
+    d = ti.Vector([ti.Vector([O[0], O[2]]).norm() - radius,
+                   abs(O[1]) - half_height])
+    return min(d.max(), 0.0) + ti.Vector([max(0, d[0]), max(0, d[1])]).norm()
+
+
+@ti.func
+def stripes_albedo(p):
+    t = int((p[0] + 10) * 1.1 + 0.5) % 3
+    return ti.Vector(
+        [0.4 + 0.3 * (t == 0), 0.4 + 0.2 * (t == 1), 0.4 + 0.3 * (t == 2)])
+
+
+@ti.func
+def node_sdf(node: ti.template(), o):
+    """
+    Distance from 'o' to the shape described by 'node'. The node is a
+    template, all the branching over the tree happens at compile time.
+    """
+    ret = 0.0
+    if ti.static(node['type'] == 'sphere'):
+        ret = sphere_sdf(o, ti.Vector(node['center']), node['radius'])
+    elif ti.static(node['type'] == 'box'):
+        ret = box_sdf(o, ti.Vector(node['center']),
+                      ti.Vector(node['half_size']))
+    elif ti.static(node['type'] == 'cylinder'):
+        ret = cylinder_sdf(o, ti.Vector(node['center']), node['radius'],
+                           node['half_height'])
+    elif ti.static(node['type'] == 'plane'):
+        ret = plane_sdf(o, ti.Vector(node['normal']), node['offset'])
+    elif ti.static(node['type'] == 'nested'):
+        ret = nested(node_sdf(node['child'], o), node['frequency'],
+                     node['thickness'])
+    else:
+        ret = node_sdf(node['children'][0], o)
+        for k in ti.static(range(1, len(node['children']))):
+            child = node_sdf(node['children'][k], o)
+            if ti.static(node['type'] == 'union'):
+                ret = min(ret, child)
+            elif ti.static(node['type'] == 'intersection'):
+                ret = max(ret, child)
+            else:  # subtraction
+                ret = max(ret, -child)
+    return ret
+
+
+def _node_bounds(node):
+    """
+    :return: (lower, upper) corners of a box containing the shape, or None if
+    it is unbounded
+    """
+    kind = node['type']
+    if kind in ('sphere', 'box', 'cylinder'):
+        if kind == 'sphere':
+            half = [node['radius']] * 3
+        elif kind == 'box':
+            half = node['half_size']
+        else:
+            half = [node['radius'], node['half_height'], node['radius']]
+        return ([c - h for c, h in zip(node['center'], half)],
+                [c + h for c, h in zip(node['center'], half)])
+    if kind == 'plane':
+        return None
+    if kind == 'nested':
+        bounds = _node_bounds(node['child'])
+        if bounds is None:
+            return None
+        # the shells move the outer surface by this much
+        grow = node['thickness'] / node['frequency']
+        return [x - grow for x in bounds[0]], [x + grow for x in bounds[1]]
+
+    bounds = [_node_bounds(child) for child in node['children']]
+    if kind == 'subtraction':
+        return bounds[0]
+    if kind == 'union':
+        if any(b is None for b in bounds):
+            return None
+        return ([min(b[0][k] for b in bounds) for k in range(3)],
+                [max(b[1][k] for b in bounds) for k in range(3)])
+    if kind == 'intersection':
+        bounds = [b for b in bounds if b is not None]
+        if not bounds:
+            return None
+        return ([max(b[0][k] for b in bounds) for k in range(3)],
+                [min(b[1][k] for b in bounds) for k in range(3)])
+    raise ValueError('Unknown scene node type: ' + kind)
+
+
+@ti.func
+def material_albedo(material: ti.template(), p):
+    ret = ti.Vector([0.0, 0.0, 0.0])
+    if ti.static(material['type'] == 'stripes'):
+        ret = stripes_albedo(p)
+    else:  # diffuse
+        ret = ti.Vector(material['albedo'])
+    return ret
+
+
+# ------------------------------ Compiling ---------------------------------
+
+class CompiledScene:
+    """
+    The 'ti.func's of a scene, along with its camera and light:
+
+    sdf(o):          the signed distance at 'o'
+    sdf_bounded(o):  same, but objects further than 'bound_margin' from their
+                     bounding box only return the distance to the box, which
+                     never over-estimates the actual one
+    material(p):     albedo of the closest object at 'p'
+    """
+
+    def __init__(self, scene, bound_margin):
+        self.scene = scene
+        self.camera_pos = scene['camera']['position']
+        self.fov = scene['camera']['fov']
+        self.light_pos = scene['light']['position']
+        self.light_normal = scene['light']['normal']
+        self.light_radius = scene['light']['radius']
+
+        shapes = [obj['shape'] for obj in scene['objects']]
+        materials = [obj.get('material', {'type': 'stripes'})
+                     for obj in scene['objects']]
+        for material in materials:
+            if material['type'] not in ('stripes', 'diffuse'):
+                raise ValueError(
+                    'Unknown material type: ' + material['type'])
+        bounds = []
+        for shape in shapes:
+            b = _node_bounds(shape)
+            if b is not None:
+                b = ([(lo + hi) * 0.5 for lo, hi in zip(*b)],
+                     [(hi - lo) * 0.5 for lo, hi in zip(*b)])
+            bounds.append(b)
+        bounded = [b is not None for b in bounds]
+
+        @ti.func
+        def sdf(o):
+            ret = inf
+            for shape in ti.static(shapes):
+                ret = min(ret, node_sdf(shape, o))
+            return ret
+
+        @ti.func
+        def sdf_bounded(o):
+            ret = inf
+            for i in ti.static(range(len(shapes))):
+                if ti.static(bounded[i]):
+                    q = ti.abs(o - ti.Vector(bounds[i][0])) - ti.Vector(
+                        bounds[i][1])
+                    dist = ti.Vector([max(0, q[0]), max(0, q[1]),
+                                      max(0, q[2])]).norm()
+                    if dist <= bound_margin:
+                        dist = node_sdf(shapes[i], o)
+                    ret = min(ret, dist)
+                else:
+                    ret = min(ret, node_sdf(shapes[i], o))
+            return ret
+
+        @ti.func
+        def material(p):
+            closest = inf
+            albedo = ti.Vector([0.0, 0.0, 0.0])
+            for i in ti.static(range(len(shapes))):
+                dist = node_sdf(shapes[i], p)
+                if dist < closest:
+                    closest = dist
+                    albedo = material_albedo(materials[i], p)
+            return albedo
+
+        self.sdf = sdf
+        self.sdf_bounded = sdf_bounded
+        self.material = material
+
+
+def compile_scene(scene, bound_margin=0.1):
+    """
+    Nothing is kept between calls: 'ti.init' throws away every compiled
+    kernel anyway. Across runs, Taichi's offline cache (see
+    'taichi_setup.init_taichi') reuses the kernels of a scene, since they
+    are keyed by their unrolled code.
+    """
+    return CompiledScene(scene, bound_margin)
@@ -0,0 +1,29 @@
+""" Taichi start-up shared by the SDF renderer and the N-body solvers.
+
+Every script allocates its fields in its own 'init()', after calling
+'init_taichi' here, so the Taichi options are the same everywhere.
+"""
+from os.path import exists
+
+import taichi as ti
+
+
+def init_taichi(arch=ti.cpu, offline_cache=False, cache_path=None,
+                timer=None, timer_dll=None):
+    """
+    Initialize Taichi. 'offline_cache' is always passed on, since newer
+    Taichi versions keep the compiled kernels on disk unless told otherwise.
+
+    :param offline_cache: keep the compiled kernels on disk (in 'cache_path',
+    or Taichi's default location) so later runs skip compiling them
+    :param timer: whether the caller should load its timer DLL, by default
+    only if 'timer_dll' exists
+    :return: whether to load the timer DLL
+    """
+    kwargs = {}
+    if cache_path is not None:
+        kwargs['offline_cache_file_path'] = cache_path
+    ti.init(arch=arch, offline_cache=offline_cache, **kwargs)
+    if timer is None:
+        timer = timer_dll is not None and exists(timer_dll)
+    return timer